@@ -1,6 +1,6 @@
 from rocketry import Rocketry
 from rocketry.conds import time_of_day, monthly, weekly, retry
-from db import get_data
+from db import dispose_engines, get_data
 from loguru import logger
 
 app = Rocketry()
@@ -34,4 +34,8 @@ def do_monthly():
 
 
 if __name__ == "__main__":
-    app.run()
+    try:
+        app.run()
+    finally:
+        # Tasks share the pooled connections; close them only once the scheduler stops
+        dispose_engines()
@@ -6,6 +6,12 @@ class Settings(BaseSettings):
     database_username:str
     database_password:str
     database_name:str
+    database_driver:str = 'pymssql' # pymssql or pyodbc
+    odbc_driver:str = 'ODBC Driver 17 for SQL Server' # Can change to other drivers
+    # Reads and writes each get a pool of this size: up to 2 x (pool_size + max_overflow) connections
+    pool_size:int = 10
+    max_overflow:int = 20
+    pool_recycle:int = 1800 # Seconds before a pooled connection is replaced
 
     class Config:
         env_file = ".env"
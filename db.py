@@ -1,45 +1,270 @@
+import asyncio
 import json
+import re
+import threading
+from collections.abc import Iterator
 from datetime import datetime
 from decimal import Decimal
-from sqlalchemy import create_engine
+from functools import lru_cache
+from sqlalchemy import URL, Connection, Engine, create_engine, text
+from sqlalchemy.sql.elements import TextClause
 from config import settings
 
-def connect_to_db():
-    """Connects to DB server using mssql and pymssql"""
-    driver = 'SQL Server Native Client 11.0' # Can change to other drivers
-    user = settings.database_username
-    db = settings.database_name
-    server = settings.database_host
-    password = settings.database_password
-    connection_string = f'mssql+pymssql://{user}:{password}@{server}/{db}'
-    engine = create_engine(connection_string)
-    connection = engine.connect()
-    dbapi_connection = connection.connection
-    cursor = dbapi_connection.cursor()
-    return cursor
-
-
-def get_data(query:str) -> list[dict]:
-    """Executes a query agains the DB and return results in a list of dictionaries"""
-    cursor = connect_to_db()
-    cursor.execute(query)
-    results = []
-    """This loop will handle datetime stamps and decimal serialization.
-        IMPORTANT: This is transforming Decimal to String. 
+
+@lru_cache(maxsize=1024)
+def _as_text(query:str) -> TextClause:
+    """Builds the TextClause for a query once and reuses it for repeated calls"""
+    return text(query)
+
+
+def _split_host(host:str) -> tuple[str, int | None]:
+    """Splits an optional :port off database_host, leaving IPv6 addresses intact"""
+    name, _, port = host.rpartition(':')
+    if port.isdigit() and (':' not in name or name.endswith(']')):
+        return name.strip('[]'), int(port)
+    return host.strip('[]'), None
+
+
+@lru_cache(maxsize=None)
+def connection_url() -> URL:
+    """Builds the connection URL for the DB server using mssql and pymssql or pyodbc.
+    It only depends on the settings, so it is built once."""
+    host, port = _split_host(settings.database_host)
+    query = {}
+    if settings.database_driver == 'pyodbc':
+        query['driver'] = settings.odbc_driver
+    return URL.create(
+        f'mssql+{settings.database_driver}',
+        username=settings.database_username,
+        password=settings.database_password, # Escaped by URL, so special characters are safe
+        host=host,
+        port=port,
+        database=settings.database_name,
+        query=query,
+    )
+
+
+_engines: dict[tuple[URL, bool], Engine] = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(autocommit:bool = False) -> Engine:
+    """Returns the engine (and its connection pool) for the DB server.
+    It is only created on first use. Autocommit engines keep a separate pool of the
+    same size, so up to 2 x (pool_size + max_overflow) connections can be open.
+    Connections are still reset when returned to either pool."""
+    url = connection_url()
+    engine = _engines.get((url, autocommit))
+    if engine is not None:
+        return engine
+    # Worker threads from get_data_async can get here at the same time on first use
+    with _engines_lock:
+        engine = _engines.get((url, autocommit))
+        if engine is None:
+            engine_options = {}
+            if settings.database_driver == 'pyodbc':
+                # Sends executemany parameters as one array instead of a round-trip per row
+                engine_options['fast_executemany'] = True
+            if autocommit:
+                engine_options['isolation_level'] = 'AUTOCOMMIT'
+            engine = _engines[(url, autocommit)] = create_engine(
+                url,
+                pool_size=settings.pool_size,
+                max_overflow=settings.max_overflow,
+                pool_pre_ping=True, # Replaces connections dropped by the server instead of failing the query
+                pool_recycle=settings.pool_recycle,
+                pool_use_lifo=True,
+                **engine_options,
+            )
+    return engine
+
+
+def connect_to_db(autocommit:bool = False) -> Connection:
+    """Checks out a connection to the DB server from the shared pool.
+    Use autocommit for reads: they skip the transaction and its extra round-trips."""
+    return get_engine(autocommit).connect()
+
+
+def dispose_engines():
+    """Closes every pooled connection. Call it once at process exit."""
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+def _serialize_row(items, _isinstance=isinstance, _datetime=datetime, _Decimal=Decimal) -> dict:
+    """Handles datetime stamps and decimal serialization of a row's (column, value) pairs.
+        IMPORTANT: This is transforming Decimal to String.
         You may change it to integers or floats if you need to.
+        The default arguments bind the names used per value as fast locals; don't pass them.
     """
-    for row in cursor.fetchall():
-        result = {}
-        for i, column in enumerate(cursor.description):
-            if isinstance(row[i], datetime):
-                result[column[0]] = row[i].strftime('%Y-%m-%d %H:%M:%S')
-            elif isinstance(row[i], Decimal):
-                result[column[0]] = str(row[i])
-            else:
-                result[column[0]] = row[i]
-        results.append(result)
-    return results # If JSON is needed change to json.dumps(result)
+    result = {}
+    for column, value in items:
+        if _isinstance(value, _datetime):
+            result[column] = value.strftime('%Y-%m-%d %H:%M:%S')
+        elif _isinstance(value, _Decimal):
+            result[column] = str(value)
+        else:
+            result[column] = value
+    return result
+
 
+def get_data(query:str, params:dict | None = None, connection=None) -> list[dict]:
+    """Executes a query agains the DB and return results in a list of dictionaries.
+    Pass an open connection (from connect_to_db) to run several queries over it
+    instead of opening a new one per call."""
+    if connection is None:
+        with connect_to_db(autocommit=True) as connection:
+            return get_data(query, params, connection)
+    rows = connection.execute(_as_text(query), params or {}).mappings().all()
+    return [_serialize_row(row.items()) for row in rows] # If JSON is needed change to json.dumps(result)
 
 
+def iter_data(query:str, params:dict | None = None, chunk_size:int = 1000) -> Iterator[dict]:
+    """Executes a query agains the DB and yields the results one dictionary at a time.
+    Rows are fetched from the server chunk_size at a time, so only one chunk is held
+    in memory. Use it over get_data for large tables; get_data is simpler and frees
+    the connection sooner for small results."""
+    with connect_to_db(autocommit=True) as connection:
+        connection.execution_options(stream_results=True, yield_per=chunk_size)
+        for row in connection.execute(_as_text(query), params or {}).mappings():
+            yield _serialize_row(row.items())
+
+
+async def get_data_async(query:str, params:dict | None = None) -> list[dict]:
+    """Runs get_data in a worker thread, so independent queries can be awaited together
+    with asyncio.gather. Each call checks out its own connection from the pool."""
+    return await asyncio.to_thread(get_data, query, params)
+
+
+def get_data_batch(queries:list[str]) -> list[list[dict]]:
+    """Executes several queries in a single round-trip and returns the results of each, in order.
+    They are sent to SQL Server as one batch, so they cannot take parameters.
+    Every query must be a SELECT that returns a result set (not SELECT ... INTO): pymssql
+    skips results without columns, which would shift the rest. Anything else is
+    rejected with ValueError before the batch is sent, as is an empty list."""
+    if not queries:
+        raise ValueError('get_data_batch needs at least one query')
+    for query in queries:
+        words = query.split(None, 1)
+        if not words or words[0].upper() != 'SELECT':
+            raise ValueError(f'get_data_batch only accepts SELECT queries, got {query!r}')
+    with connect_to_db(autocommit=True) as connection:
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute(';\n'.join(queries))
+            results = []
+            while True:
+                if cursor.description is not None:
+                    columns = [column[0] for column in cursor.description]
+                    results.append([_serialize_row(zip(columns, row)) for row in cursor.fetchall()])
+                if not cursor.nextset():
+                    break
+        finally:
+            cursor.close()
+    if len(results) != len(queries):
+        raise ValueError(f'Expected {len(queries)} result sets from the batch, got {len(results)}')
+    return results
+
+
+_DEDUP_STATEMENTS = ('UPDATE', 'DELETE')
+
+
+def _dedup_params(query:str, params_list:list[dict]) -> list[dict]:
+    """Drops repeated parameter sets, keeping the first occurrence of each.
+    Only UPDATE and DELETE statements are accepted, since an INSERT would write fewer rows."""
+    words = query.split(None, 1)
+    if not words or words[0].upper() not in _DEDUP_STATEMENTS:
+        raise ValueError('dedup is only supported for UPDATE and DELETE statements')
+    seen = set()
+    unique = []
+    for params in params_list:
+        try:
+            key = frozenset(params.items())
+            is_new = key not in seen
+        except TypeError as e:
+            raise ValueError(f'dedup needs hashable parameter values, got {params!r}') from e
+        if is_new:
+            seen.add(key)
+            unique.append(params)
+    return unique
+
+
+# INSERT [INTO] table [(columns)] VALUES (row): the head can't hold ';', ':' or more parentheses,
+# and the row can't hold string literals, so multi-statement batches, INSERT ... SELECT and
+# nested calls in the row never match
+_INSERT_VALUES = re.compile(
+    r"^(\s*INSERT\s+(?:INTO\s+)?[^;:()]+?\s*(?:\([^;:()]*\)\s*)?VALUES\s*)\(([^;()']*)\)\s*;?\s*$",
+    re.IGNORECASE,
+)
+_BIND_PARAM = re.compile(r'(?<![:\w]):(\w+)')
+_MAX_INSERT_ROWS = 1000 # SQL Server limit for rows in a VALUES list
+_MAX_BIND_PARAMS = 2100 # SQL Server limit for parameters in a statement
+
+
+def _expand_insert(query:str, params_list:list[dict]) -> list[tuple[str, dict]] | None:
+    """Rewrites a single row INSERT ... VALUES (:a, :b) into multi-row INSERTs that cover
+    every parameter set, chunked to stay within SQL Server limits.
+    Returns None when the statement has another form, so executemany is used instead.
+
+    >>> _expand_insert('INSERT INTO t (a) VALUES (:a)', [{'a': 1}, {'a': 2}])
+    [('INSERT INTO t (a) VALUES (:a_0), (:a_1)', {'a_0': 1, 'a_1': 2})]
+    >>> _expand_insert('INSERT INTO t (a) VALUES (:a); INSERT INTO u (b) VALUES (:b)', [{'a': 1, 'b': 1}]) is None
+    True
+    >>> _expand_insert('INSERT INTO t (a) SELECT a FROM u WHERE a = :a', [{'a': 1}]) is None
+    True
+    >>> _expand_insert('INSERT INTO t (a, b) VALUES (:a, GETDATE())', [{'a': 1}]) is None
+    True
+    >>> _expand_insert('INSERT INTO t (a, b) VALUES (:a, :b)', [{'a': 1, 'b': 2}, {'a': 3}])
+    Traceback (most recent call last):
+    ...
+    ValueError: Parameter set {'a': 3} is missing b
+    """
+    match = _INSERT_VALUES.match(query)
+    if match is None:
+        return None
+    head, row = match.groups()
+    names = set(_BIND_PARAM.findall(row))
+    if not names or len(names) > _MAX_BIND_PARAMS:
+        return None
+    for row_params in params_list:
+        missing = names.difference(row_params)
+        if missing:
+            raise ValueError(f'Parameter set {row_params!r} is missing {", ".join(sorted(missing))}')
+    chunk_size = min(_MAX_INSERT_ROWS, _MAX_BIND_PARAMS // len(names))
+    statements = []
+    for start in range(0, len(params_list), chunk_size):
+        values = []
+        params = {}
+        for i, row_params in enumerate(params_list[start:start + chunk_size]):
+            values.append('(' + _BIND_PARAM.sub(lambda bind: f':{bind.group(1)}_{i}', row) + ')')
+            params.update({f'{name}_{i}': row_params[name] for name in names})
+        statements.append((head + ', '.join(values), params))
+    return statements
+
 
+def execute_many(query:str, params_list:list[dict], connection=None, dedup:bool = False) -> int:
+    """Executes a statement for every parameter set with a single executemany call.
+    Simple INSERT ... VALUES statements are sent as multi-row INSERTs instead.
+    Without a connection, it runs in its own transaction and commits at the end.
+    With dedup, repeated parameter sets are NOT executed again: only the first of each is sent,
+    and the returned count only covers those. It is limited to UPDATE and DELETE, and
+    should only be used when running the same parameters twice has no further effect
+    (e.g. not SET total = total + :amount).
+    Every parameter set must have the same keys.
+    Returns the number of affected rows."""
+    if dedup:
+        params_list = _dedup_params(query, params_list)
+    if not params_list:
+        return 0
+    if connection is None:
+        with connect_to_db() as connection, connection.begin():
+            return execute_many(query, params_list, connection)
+    # pyodbc already sends the whole batch at once with fast_executemany
+    if settings.database_driver != 'pyodbc':
+        statements = _expand_insert(query, params_list)
+        if statements is not None:
+            return sum(connection.execute(_as_text(sql), params).rowcount for sql, params in statements)
+    cursor = connection.execute(_as_text(query), params_list)
+    return cursor.rowcount